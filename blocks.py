@@ -61,11 +61,15 @@ class Block:
 class Section(Block):
     section_levels = {1: 'section', 2: 'subsection', 3: 'subsubsection'}
 
-    def __init__(self, h_level, title, content, fig_path):
+    def __init__(self, h_level, title, content, fig_path, children=None):
         super().__init__(content)
         self.h_level = h_level
         self.title = title
-        self.children = to_blocks(content, fig_path, parent=self)
+        if children is None:
+            children = to_blocks(content, fig_path, parent=self)
+        for child in children:
+            child.parent = self
+        self.children = children
         self.md_file_path = None
         self.tex_file_path = None
 
@@ -23,48 +23,82 @@ SOFTWARE.
 """
 
 import re
-import copy
+import os
+import functools
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 LATEX_SPECIAL_CHARS = r'$%_}&#{'
-
-
+LATEX_ESCAPE = str.maketrans({special_char: f'\\{special_char}' for special_char in LATEX_SPECIAL_CHARS})
+PARALLEL_MIN_LINES = 5000  # below this, starting worker processes costs more than formatting the lines
+PLACEHOLDER = '\x00{}\x00'  # stands for the n-th protected inline content (equations, links and code) while formatting
+
+# ===== BLOCK-LEVEL PATTERNS =====
+PAT_HEADER = re.compile(r'^(#{1,3})\s(.*)')
+PAT_HEADER_LVL = [None] + [re.compile(f'^(#{{{n}}})\\s(.*)') for n in range(1, 7)]
+PAT_FOOTNOTE = re.compile(r'^\[\^(.+?)]:(.*)')
+PAT_CMD = re.compile(r'^#{4}\s(.*)')
+PAT_FIGURE = re.compile(r'^!\[\[(.+\.png|.+\.jpg)\]\](.*)$')
+PAT_QUOTE_PREFIX = re.compile(r'^\s*> ?')
+PAT_FIG_CAPTION = re.compile(r'^`(.*?)`:(.*)')
+PAT_EQLABEL = re.compile(r'`eq_label:(\S.*)`')
+# All of the above in one pattern, in the order in which to_blocks gives them precedence. The name of the matching
+# group is the kind of the line; lines that match none of them are paragraph text.
+PAT_LINE = re.compile(r'''
+    (?P<blank>\s*$)
+  | (?P<command>\#{4}\s.+)
+  | (?P<separator>\s*---\s*$)
+  | (?P<header>(?P<h_marks>\#{1,3})\s(?P<title>.*))
+  | (?P<equation>\s*\$\$)
+  | (?P<labeled_equation>\s*`eq_label:\S.*`)
+  | (?P<list>\s*-)
+  | (?P<quote>\s*>)
+  | (?P<figure>\s*!\[\[(?:.+\.png|.+\.jpg)\]\].*\s*\Z)
+  | (?P<footnote>\[\^.+?]:)
+''', re.VERBOSE)
+PARAGRAPH_END_KINDS = {'blank', 'command', 'separator', 'header', 'equation', 'labeled_equation', 'list', 'quote'}
+
+# ===== INLINE PATTERNS =====
+PAT_SIGIL = re.compile(r'[$%_}&#{\[`*=]')  # characters that _format_line may have to change or act upon
+PAT_PROTECTED = re.compile(r'\$.*?\$|\[\[.*?]]|`.*?`')
+PAT_PLACEHOLDER = re.compile(PLACEHOLDER.format(r'(\d+)'))
+PAT_BRACKETS = re.compile(r'(?<!\[)(\[.*])(?!])')
+PAT_CITE_CODE = re.compile(r'`(\w+(?:18|19|20)\d{2}\w*)`')
+PAT_CITE_KEY = re.compile(r'\[\[(\w+(?:18|19|20)\d{2}\w*)\]\]')
+PAT_CITE_RUN = re.compile(r'\[\[\w+(?:18|19|20)\d{2}\w*\]\](?:[,\s]{0,2}\[\[\w+(?:18|19|20)\d{2}\w*\]\])+')
+PAT_CITE_MD = re.compile(r'\[\[(\w+(?:18|19|20)\d{2}\S*?)\]\]')
+PAT_REF_FIG = re.compile(r'`(fig:\S*?)`')
+PAT_REF_EQ = re.compile(r'`(eq:\S*?)`')
+# Monospace, bold, italics with quote marks, italics and highlight. The group that matches tells the Latex command
+PAT_INLINE = re.compile(r'`(.*?)`|\*\*([^\*].*?)\*\*|(?<!\*)\*"([^\*].*?)"\*(?!\*)|(?<!\*)\*([^\*].*?)\*(?!\*)|==([^=].*?)==')
+INLINE_COMMANDS = (None, 'texttt', 'textbf', 'textquote', 'textit', 'hl')
+
+
+# The detectors return the regex match (or None) so that callers read only the groups they need, e.g. the header level
+# is match.end(1) and its title match.group(2)
 def detect_header(line, level=None):
-    if level:
-        match = re.match(f'^(#{{{level}}})\s(.*)', line)
-    else:
-        match = re.match(r'^(#{1,3})\s(.*)', line)
-
-    if match:
-        return {'h_level': len(match.group(1)), 'title': match.group(2)}
-    else:
-        return False
+    return PAT_HEADER_LVL[level].match(line) if level else PAT_HEADER.match(line)
 
 
 def detect_footnote(line):
-    if match := re.match(r'^\[\^(.+?)]:(.*)', line):
-        return match.group(1), match.group(2).strip()
-    return False
+    return PAT_FOOTNOTE.match(line)
 
 
 def detect_command(line):
-    if match := re.match(r'^#{4}\s(.*)', line):
+    if match := PAT_CMD.match(line):
         return match.group(1)
     else:
         return False
 
 def detect_figure(line):
-    match = re.match(r'^!\[\[(.+\.png|.+\.jpg)\]\](.*)$', line.strip())
-    is_figure = bool(match)
-    if is_figure:
-        name = match.group(1)
-        settings = [] if match.group(2)=='' else match.group(2).split(' ')
-        return [name] + settings
-    else:
-        return False
+    if match := PAT_FIGURE.match(line.strip()):
+        return match.group(1), match.group(2)  # file name and settings string
+    return False
 
 
 def detect_labeled_equation(line):
-    match = re.match(r'`eq_label:(\S.*)`', line.strip())
+    match = PAT_EQLABEL.match(line.strip())
     is_labeled_equation = bool(match)
     if is_labeled_equation:
         return "eq:"+match.group(1).strip()
@@ -72,8 +106,7 @@ def detect_labeled_equation(line):
         return False
 
 
-def is_comment(line):
-    return detect_command(line)
+is_comment = detect_command  # comments are the four-level headers used for commands
 
 
 def is_command(line, command):
@@ -84,33 +117,93 @@ def is_command(line, command):
 
 
 def is_end_paragraph(line):
-    return is_ignore_line(line) or is_separator_line(line) or is_equation_dollars(line) or is_list_item(line) or is_quote(line) or detect_command(line) or detect_labeled_equation(line) or detect_header(line)
+    s = line.strip()
+    if not s or s.startswith(('$$', '-', '>')):  # separators (---) start with '-' too
+        return True
+    # Only run the regexes that can match: commands and headers start with '#', labeled equations with `eq_label:
+    if line.startswith('#'):
+        return bool(detect_command(line) or detect_header(line))
+    return s.startswith('`eq_label:') and bool(PAT_EQLABEL.match(s))
 
 
 def is_equation_dollars(line):
-    return line.strip()[:2] == '$$'
+    return _is_eq_s(line.strip())
 
 
 def is_list_item(line):
-    return False if len(line.strip()) == 0 else line.strip()[0] == '-'
+    return _is_list_s(line.strip())
 
 
 def is_quote(line):
-    return False if len(line.strip()) == 0 else line.strip()[0] == '>'
+    return _is_quote_s(line.strip())
+
 
 def is_ignore_line(line):
-    return len(line.strip()) == 0 or is_comment(line)
+    return _is_ignore_s(line.strip(), detect_command(line))
 
 
 def is_separator_line(line):
-    return line.strip() == '---'
+    return _is_sep_s(line.strip())
+
+
+# The predicates below take the already stripped line <s>, and the command detected on the raw line where needed, so
+# that callers iterating over many lines strip each line and run each regex on it only once.
+def _is_eq_s(s):
+    return s[:2] == '$$'
+
+
+def _is_list_s(s):
+    return s[:1] == '-'
+
+
+def _is_quote_s(s):
+    return s[:1] == '>'
+
+
+def _is_ignore_s(s, command):
+    return len(s) == 0 or command
+
+
+def _is_sep_s(s):
+    return s == '---'
+
+
+class LinesView:
+    """Read-only view of lines[start:end] that avoids copying the lines of (nested) sections"""
+    def __init__(self, lines, start, end):
+        if isinstance(lines, LinesView):
+            lines, start, end = lines.lines, lines.start + start, lines.start + end
+        self.lines = lines
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return self.lines[self.start + start: self.start + max(start, stop)]
+            return [self.lines[self.start + i] for i in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('LinesView index out of range')
+        return self.lines[self.start + index]
+
+    def __iter__(self):
+        return itertools.islice(self.lines, self.start, self.end)
 
 
-def find_next_index(lst, expr, start=0):
-    for i in range(start, len(lst)):
-        if expr(lst[i]):
-            return i
-    return len(lst)
+class _SectionFrame:
+    """A section whose header has been read but whose end has not been found yet"""
+    def __init__(self, h_level=None, title=None, start=0):
+        self.h_level = h_level
+        self.title = title
+        self.start = start  # index of the first content line
+        self.blocks = []
+        self.is_ignoring = False
 
 
 """
@@ -127,127 +220,201 @@ def find_next_index(lst, expr, start=0):
 
 def to_blocks(text_lines, fig_path, parent=None):
     from blocks import Section, Paragraph, Equation, List, Quote, Figure, Footnote
-    if issubclass(str, type(text_lines)):
+    if isinstance(text_lines, str):
         text_lines = text_lines.splitlines()
 
-    content_blocks = []
-    is_ignoring = False
+    # Single pass over the lines. Sections still open are kept in a stack of frames (the bottom one collects the blocks
+    # returned to the caller). A section ends at the next header of its own level, which also ends its open subsections.
+    frames = [_SectionFrame()]
+    block_kind = None  # kind of the multi-line block being read ('equation', 'list', 'quote' or 'paragraph')
+    block_start = 0
+    block_label = ''
+
+    def add_block(block):
+        if not frames[-1].is_ignoring:
+            frames[-1].blocks.append(block)
+
+    def close_block(end):
+        nonlocal block_kind
+        content = text_lines[block_start: end]
+        if block_kind == 'equation':
+            add_block(Equation(content=content, label=block_label))
+        elif block_kind == 'list':
+            add_block(List(content=content))
+        elif block_kind == 'quote':
+            add_block(Quote(content=[PAT_QUOTE_PREFIX.sub('', line, count=1) for line in content]))
+        else:
+            add_block(Paragraph(content=content))
+        block_kind = None
+
+    def close_section(end):
+        frame = frames.pop()
+        if frame.is_ignoring:
+            print(f'\t\tWARNING: did not find a matching separator')
+        add_block(Section(h_level=frame.h_level, title=frame.title, content=LinesView(text_lines, frame.start, end),
+                          fig_path=fig_path, children=frame.blocks))
+
+    # Classify all the lines up front (map keeps the loop calling the regex in C)
+    matches = list(map(PAT_LINE.match, text_lines))
+    kinds = [match.lastgroup if match else 'paragraph' for match in matches]
+
     i = 0
     while i < len(text_lines):
-        block = None
+        line = text_lines[i]
+        match = matches[i]
+        kind = kinds[i]
+
+        # A header closes the open section of the same level, together with everything nested in it
+        if kind == 'header' and any(frame.h_level == match.end('h_marks') for frame in frames):
+            if block_kind is not None:
+                close_block(i)
+            while frames[-1].h_level != match.end('h_marks'):
+                close_section(i)
+            close_section(i)
+
+        # CONTINUE MULTI-LINE BLOCK
+        if block_kind == 'equation':
+            if kind == 'equation':
+                close_block(i)  # line with $$ must be skipped
+            i += 1
+            continue
+        elif block_kind == 'list' and kind in ('list', 'separator') or block_kind == 'quote' and kind == 'quote' \
+                or block_kind == 'paragraph' and kind not in PARAGRAPH_END_KINDS:
+            i += 1
+            continue
+        elif block_kind is not None:
+            close_block(i)
+
         # PROCESS EMPTY LINES, HORIZONTAL LINES, COMMENTS
-        if is_ignore_line(text_lines[i]):
+        if kind in ('blank', 'command'):
             i += 1
-        elif is_separator_line(text_lines[i]):
-            is_ignoring = not is_ignoring
+        elif kind == 'separator':
+            frames[-1].is_ignoring = not frames[-1].is_ignoring
             i += 1
         # PROCESS SECTION BLOCK
-        elif header := detect_header(text_lines[i]):
-            h_level = header['h_level']
-            title = header['title']
-            end_section_i = find_next_index(text_lines, lambda l: detect_header(l, h_level), i + 1)
-            block = Section(h_level=h_level, title=title, content=text_lines[i + 1: end_section_i], fig_path=fig_path)
-            i = end_section_i
+        elif kind == 'header':
+            frames.append(_SectionFrame(h_level=match.end('h_marks'), title=match.group('title'), start=i + 1))
+            i += 1
         # PROCESS EQUATION BLOCK (unlabeled)
-        elif is_equation_dollars(text_lines[i]):
-            end_equation_i = find_next_index(text_lines, lambda l: is_equation_dollars(l), i + 1)
-            block = Equation(content=text_lines[i + 1: end_equation_i])
-            i = end_equation_i + 1  # line with $$ must be skipped # PROCESS EQUATION BLOCK (unlabeled)
+        elif kind == 'equation':
+            block_kind, block_start, block_label = 'equation', i + 1, ''
+            i += 1
         # PROCESS EQUATION BLOCK (labeled)
-        elif label := detect_labeled_equation(text_lines[i]):
-            assert is_equation_dollars(text_lines[i + 1]), 'Equation dollars must be alone in a line'
-            i += 1  # skip next line because it just contains the double dollar
-            end_equation_i = find_next_index(text_lines, lambda l: is_equation_dollars(l), i + 1)
-            block = Equation(content=text_lines[i + 1: end_equation_i], label=label)
-            i = end_equation_i + 1  # line with $$ must be skipped
+        elif kind == 'labeled_equation':
+            assert _is_eq_s(text_lines[i + 1].strip()), 'Equation dollars must be alone in a line'
+            # skip next line because it just contains the double dollar
+            block_kind, block_start, block_label = 'equation', i + 2, detect_labeled_equation(line)
+            i += 2
         # PROCESS LIST BLOCK
-        elif is_list_item(text_lines[i]):
-            end_list_i = find_next_index(text_lines, lambda l: not is_list_item(l), i + 1)
-            block = List(content=text_lines[i: end_list_i])
-            i = end_list_i
+        elif kind == 'list':
+            block_kind, block_start = 'list', i
+            i += 1
         # PROCESS QUOTE BLOCK
-        elif is_quote(text_lines[i]):
-            end_quote_i = find_next_index(text_lines, lambda l: not is_quote(l), i + 1)
-            block = Quote(content=[line.lstrip('> ') for line in text_lines[i: end_quote_i]])
-            i = end_quote_i
+        elif kind == 'quote':
+            block_kind, block_start = 'quote', i
+            i += 1
         # PROCESS FIGURE BLOCK
-        elif settings := detect_figure(text_lines[i]):
-            alt_data = re.match(r'^`(.*?)`:(.*)', text_lines[i+1])
+        elif kind == 'figure':
+            name, settings = detect_figure(line)
+            settings = [name] + settings.split(' ') if settings else [name]
+            alt_data = PAT_FIG_CAPTION.match(text_lines[i+1])
             assert alt_data, f'Caption of figure <{settings[0]}> badly formed'
             label = alt_data.group(1).strip()
             caption = alt_data.group(2).strip()
-            block = Figure(settings=settings, label=label, caption=caption, path=fig_path)
+            add_block(Figure(settings=settings, label=label, caption=caption, path=fig_path))
             i = i + 2  # figures are just one line for the command and another for the label and caption
         # PROCESS FOOTNOTE BLOCK
-        elif footnote_match := detect_footnote(text_lines[i]):
-            block = Footnote(footnote_mark=footnote_match[0], content=[footnote_match[1]])
+        elif kind == 'footnote':
+            footnote_match = detect_footnote(line)
+            add_block(Footnote(footnote_mark=footnote_match.group(1), content=[footnote_match.group(2).strip()]))
             i = i + 1  # Markdown footnotes are just one line
         # PROCESS PARAGRAPH BLOCK
         else:
-            end_paragraph_i = find_next_index(text_lines, lambda l: is_end_paragraph(l), i + 1)
-            block = Paragraph(content=text_lines[i: end_paragraph_i])
-            i = end_paragraph_i
+            block_kind, block_start = 'paragraph', i
+            i += 1
 
-        if block is not None:
-            block.parent = parent
-            if not is_ignoring:
-                content_blocks.append(block)
+    if block_kind is not None:
+        close_block(len(text_lines))
+    while len(frames) > 1:
+        close_section(len(text_lines))
 
-    if is_ignoring:
+    if frames[0].is_ignoring:
         print(f'\t\tWARNING: did not find a matching separator')
-    return content_blocks
+    for block in frames[0].blocks:
+        block.parent = parent
+    return frames[0].blocks
+
+
+def escape_specials(text):
+    return text.translate(LATEX_ESCAPE)
+
+
+def protect(line, protected):
+    def placeholder(match):
+        protected.append(match.group(0))
+        return PLACEHOLDER.format(len(protected) - 1)
+    return PAT_PROTECTED.sub(placeholder, line)
+
+
+def join_citations(match):
+    return f"\\cite{{{','.join(PAT_CITE_KEY.findall(match.group(0)))}}}"
+
+
+@functools.lru_cache(maxsize=65536)  # notes repeat many lines (blank lines, separators, headings...)
+def _format_line(line):
+    # Plain text is left as is
+    if not PAT_SIGIL.search(line):
+        return line
+
+    # ===== SPECIAL CHARACTERS =====
+    # Swap equations, links and code for numbered placeholders, so that they are neither escaped nor grouped in brackets
+    protected = []
+    line = protect(line, protected)
+    # Format special chars that need to be escaped
+    line = escape_specials(line)
+    # Put square brackets in a group so that they are not parsed in latex as block arguments
+    line = PAT_BRACKETS.sub(r'{\1}', line)
+    # put back equations, links and code
+    line = PAT_PLACEHOLDER.sub(lambda match: protected[int(match.group(1))], line)
+
+    # ===== CITATIONS AND REFERENCES =====
+    # Replace Markdown code key citations by Markdown note key citations
+    line = PAT_CITE_CODE.sub(r'[[\1]]', line)
+    # Join consecutive citations (turns [[key1]], [[key2]] into \cite{key1,key2})
+    line = PAT_CITE_RUN.sub(join_citations, line)
+    # Replace the remaining (single) Markdown note key citations by Latex citations
+    line = PAT_CITE_MD.sub(r'\\cite{\1}', line)
+    # Replace Markdown figure references by Latex references
+    line = PAT_REF_FIG.sub(r'\\ref{\1}', line)
+    # Replace Markdown equation references by Latex references
+    line = PAT_REF_EQ.sub(r'\\ref{\1}', line)
+
+    # ===== TEXT FORMATTING =====
+    # Replace Markdown monospace, bold, italics (with quote marks) and highlight by their Latex counterparts in one pass
+    # (note: do after other code blocks like refs and citations)
+    line = PAT_INLINE.sub(format_inline, line)
+
+    return line
+
+
+def format_inline(match):
+    # Formatting can be nested (e.g. italics within bold), so the content is formatted too
+    content = PAT_INLINE.sub(format_inline, match.group(match.lastindex))
+    return f'\\{INLINE_COMMANDS[match.lastindex]}{{{content}}}'
 
 
 def format_text(text_lines_origin):
-    text_lines = copy.deepcopy(text_lines_origin)
-    for i in range(len(text_lines)):
-        # ===== SPECIAL CHARACTERS =====
-        # Extract and replace by placeholders equations and links before making formatting
-        equations = re.findall(r'\$.*?\$', text_lines[i])
-        links = re.findall(r'\[\[.*?]]', text_lines[i])
-        codes = re.findall(r'`.*?`', text_lines[i])
-        text_lines[i] = re.sub(r'\$.*?\$', '<EQ-PLACEHOLDER>', text_lines[i])
-        text_lines[i] = re.sub(r'\[\[.*?]]', '<LINK-PLACEHOLDER>', text_lines[i])
-        text_lines[i] = re.sub(r'`.*?`', '<CODE-PLACEHOLDER>', text_lines[i])
-        # Format special chars that need to be escaped
-        for special_char in LATEX_SPECIAL_CHARS:
-            text_lines[i] = text_lines[i].replace(special_char, f"\\{special_char}")
-        # Put square brackets in a group so that they are not parsed in latex as block arguments
-        text_lines[i] = re.sub(r'(?<!\[)(\[.*])(?!])', r'{\1}', text_lines[i])
-        # put back equations and links
-        for link in links:
-            text_lines[i] = text_lines[i].replace(r'<LINK-PLACEHOLDER>', link, 1)
-        for equation in equations:
-            text_lines[i] = text_lines[i].replace(r'<EQ-PLACEHOLDER>', equation, 1)
-        for code in codes:
-            text_lines[i] = text_lines[i].replace(r'<CODE-PLACEHOLDER>', code, 1)
-
-        # ===== CITATIONS AND REFERENCES =====
-        # Replace Markdown code key citations by Markdown note key citations
-        text_lines[i] = re.sub(r'`(\w+[18|19|20]\d{2}\w*)`', r'[[\1]]', text_lines[i])
-        # Join consecutive citations (turns [[key1]], [[key2]] into [[key1,key2]])
-        joining = True
-        while joining:
-            length_before = len(text_lines[i])
-            text_lines[i] = re.sub(r'(\w+[18|19|20]\d{2}\w*?)\]\][,|\s]{0,2}\[\[(\w+[18|19|20]\d{2}\w*?)', r'\1,\2', text_lines[i])
-            joining = len(text_lines[i]) != length_before
-        # Replace Markdown note key citations by Latex citations, handles consecutive citations too
-        text_lines[i] = re.sub(r'\[\[(\w+[18|19|20]\d{2}\S*?)\]\]', r'\\cite{\1}', text_lines[i])
-        # Replace Markdown figure references by Latex references
-        text_lines[i] = re.sub(r'`(fig:\S*?)`', r'\\ref{\1}', text_lines[i])
-        # Replace Markdown equation references by Latex references
-        text_lines[i] = re.sub(r'`(eq:\S*?)`', r'\\ref{\1}', text_lines[i])
-
-        # ===== TEXT FORMATTING =====
-        # Replace Markdown monospace by latex monospace (note: do after other code blocks like refs and citations)
-        text_lines[i] = re.sub(r'`(.*?)`', r'\\texttt{\1}', text_lines[i])
-        # Replace Markdown italics with quote marks by Latex text quote
-        text_lines[i] = re.sub(r'(?<!\*)\*"([^\*].*?)"\*(?!\*)', r'\\textquote{\1}', text_lines[i])
-        # Replace Markdown italics by Latex italics
-        text_lines[i] = re.sub(r'(?<!\*)\*([^\*].*?)\*(?!\*)', r'\\textit{\1}', text_lines[i])
-        # Replace Markdown bold by Latex bold
-        text_lines[i] = re.sub(r'\*\*([^\*].*?)\*\*', r'\\textbf{\1}', text_lines[i])
-        # Replace Markdown highlight by Latex highlight
-        text_lines[i] = re.sub(r'==([^=].*?)==', r'\\hl{\1}', text_lines[i])
-
-    return text_lines
+    # Blocks are formatted more than once (e.g. paragraphs on creation and on output), so results are cached by content.
+    # A new list is returned every time because callers edit it in place
+    return list(_format_text_cached(tuple(text_lines_origin)))
+
+
+@functools.lru_cache(maxsize=4096)
+def _format_text_cached(text_lines):
+    # Lines are formatted independently, so large inputs are split among worker processes. Only forked workers are used:
+    # they inherit the compiled patterns and, unlike spawned ones, do not import (and thus run) main.py again
+    if len(text_lines) < PARALLEL_MIN_LINES or 'fork' not in multiprocessing.get_all_start_methods():
+        return tuple(_format_line(line) for line in text_lines)
+    chunksize = max(1, len(text_lines) // (4 * (os.cpu_count() or 1)))
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context('fork')) as executor:
+        return tuple(executor.map(_format_line, text_lines, chunksize=chunksize))
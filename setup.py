@@ -0,0 +1,37 @@
+"""
+MIT License
+
+Copyright (c) 2020 Alejandro Daniel Noel
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+# Optional: compiles parser_utils.py with Cython. Python imports the resulting extension module instead of the source
+# file when both are next to each other, so nothing else changes. Build it with
+#     python setup.py build_ext --inplace
+from setuptools import setup, Extension
+from Cython.Build import cythonize
+
+setup(
+    name='obsidian-to-latex',
+    ext_modules=cythonize(
+        [Extension('parser_utils', ['parser_utils.py'], extra_compile_args=['-O3'])],
+        compiler_directives={'language_level': 3},
+    ),
+)